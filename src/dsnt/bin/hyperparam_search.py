@@ -146,7 +146,7 @@ def main():
 
         in_var = Variable(batch['input'].cuda(), requires_grad=False)
         target_var = Variable(batch['part_coords'].cuda(), requires_grad=False)
-        mask_var = Variable(batch['part_mask'].type(torch.cuda.FloatTensor), requires_grad=False)
+        mask_var = Variable(batch['part_mask'].cuda(), requires_grad=False)
 
         # Calculate predictions and loss
         out_var = model(in_var)
@@ -159,7 +159,7 @@ def main():
         # Update parameters
         optimiser.step()
 
-        return loss.data[0]
+        return loss.item()
 
     optimiser = SGD(model.parameters(), lr=1, weight_decay=args.weight_decay,
                     momentum=args.momentum)
@@ -7,9 +7,11 @@ It is expected that the full dataset is available in `/datasets/mpii`.
 """
 
 import argparse
+import contextlib
 import datetime
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import progressbar
@@ -17,19 +19,26 @@ import tele
 import tele.meter
 import torch
 import torchnet.meter
+from tele.folder.views import Cell, View
 from torch import optim
-from torch.autograd import Variable
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
-from torchvision.transforms import ToPILImage
+from torchvision.transforms.functional import to_pil_image
 from torchviz import make_dot
 
-from dsnt.data import MPIIDataset
+from dsnt.data import MPIIDataset, CUDAPrefetcher, worker_loader_options
 from dsnt.evaluator import PCKhEvaluator
 from dsnt.hyperparam_scheduler import make_1cycle
+from dsnt.meter import FastAverageMeter
 from dsnt.model import build_mpii_pose_model
 from dsnt.util import draw_skeleton, timer, generator_timer, seed_random_number_generators
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, it just makes saving metrics faster
+    orjson = None
+
 
 def parse_args():
     """Parse command-line arguments."""
@@ -79,6 +88,18 @@ def parse_args():
                         help='keywords to tag this experiment with')
     parser.add_argument('--seed', type=int, metavar='N',
                         help='seed for random number generators')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='compile the model with torch.compile (requires PyTorch 2.0+)')
+    parser.add_argument('--channels-last', action='store_true', default=False,
+                        help='use the channels-last memory format (requires PyTorch 1.5+)')
+    parser.add_argument('--sync-timers', action='store_true', default=False,
+                        help='synchronise the GPU when timing training steps, so that the time '
+                             'breakdown is accurate (slows down training)')
+    parser.add_argument('--amp', type=str, default='none', metavar='S',
+                        choices=['none', 'fp16', 'bf16'],
+                        help='mixed precision mode (requires PyTorch 1.10+, default="none")')
+    parser.add_argument('--model-graph', action='store_true', default=False,
+                        help='generate a Graphviz visualisation of the model for Showoff')
 
     args = parser.parse_args()
 
@@ -101,6 +122,64 @@ def parse_args():
     return args
 
 
+def _finite_or_none(value):
+    """Replace non-finite floats (which are not valid JSON) in `value` with None."""
+
+    if isinstance(value, (float, np.floating)):
+        return float(value) if np.isfinite(value) else None
+    if isinstance(value, dict):
+        return {k: _finite_or_none(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite_or_none(v) for v in value]
+    return value
+
+
+def _json_line(values):
+    """Serialise `values` to a line of compact JSON (as bytes).
+
+    NaN and infinite values are written as null, whether or not orjson is available.
+    """
+
+    values = _finite_or_none(values)
+    if orjson is not None:
+        return orjson.dumps(values, option=orjson.OPT_SERIALIZE_NUMPY) + b'\n'
+    line = json.dumps(values, separators=(',', ':'), allow_nan=False)
+    return (line + '\n').encode('utf-8')
+
+
+class _GrowingJSONLinesCell(Cell):
+    def __init__(self, meter_names, file_path):
+        super().__init__(meter_names, file_path)
+        self.file_path = file_path
+        self._meters = None
+
+    def render(self, step_num, meters):
+        if self._meters is None:
+            # First step. The same meters are passed in at every step, so they only need to be
+            # collected once. The output directory may or may not have been created already.
+            self._meters = tuple(meters)
+            os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+        values = dict(zip(self.meter_names, [meter.value() for meter in self._meters]))
+        # Each step is appended as a single line, so the cost of saving a step doesn't grow
+        # with the number of steps already saved
+        with open(self.file_path, 'ab') as f:
+            f.write(_json_line(values))
+
+
+class GrowingJSONLines(View):
+    """Save meter values to a newline-delimited JSON file, one line per step.
+
+    The saved values can be read back with `dsnt.util.read_json_lines`.
+    """
+
+    def __init__(self, meter_names, file_name):
+        super().__init__(meter_names, file_name)
+        self.file_name = file_name
+
+    def build(self, dir_path):
+        return _GrowingJSONLinesCell(self.meter_names, os.path.join(dir_path, self.file_name))
+
+
 class Reporting:
     """Helper class for setting up metric reporting outputs."""
 
@@ -108,11 +187,11 @@ class Reporting:
         self.telemetry = tele.Telemetry({
             'experiment_id': tele.meter.ValueMeter(skip_reset=True),
             'epoch': tele.meter.ValueMeter(),
-            'train_loss': torchnet.meter.AverageValueMeter(),
-            'val_loss': torchnet.meter.AverageValueMeter(),
+            'train_loss': FastAverageMeter(),
+            'val_loss': FastAverageMeter(),
             'epoch_time': torchnet.meter.TimeMeter(unit=False),
             'train_data_load_time': torchnet.meter.AverageValueMeter(),
-            'train_data_transfer_time': torchnet.meter.AverageValueMeter(),
+            'train_input_prep_time': torchnet.meter.AverageValueMeter(),
             'train_forward_time': torchnet.meter.AverageValueMeter(),
             'train_criterion_time': torchnet.meter.AverageValueMeter(),
             'train_backward_time': torchnet.meter.AverageValueMeter(),
@@ -149,18 +228,18 @@ class Reporting:
         from tele.folder import views
 
         self.telemetry.sink(tele.folder.Conf(out_dir), [
-            views.GrowingJSON(['epoch', 'train_loss', 'val_loss', 'epoch_time',
-                'train_pckh_total', 'val_pckh_total'], 'saved_metrics.json'),
+            GrowingJSONLines(['epoch', 'train_loss', 'val_loss', 'epoch_time',
+                'train_pckh_total', 'val_pckh_total'], 'saved_metrics.jsonl'),
             views.HDF5(['val_preds'], 'val_preds.h5', {'val_preds': 'preds'}),
             views.HDF5(['best_val_preds'], 'val_preds-best.h5', {'best_val_preds': 'preds'}),
         ])
 
-    def setup_showoff_output(self, notebook):
+    def setup_showoff_output(self, notebook, model_graph=False):
         """Setup Showoff reporting output."""
 
         from tele.showoff import views
 
-        self.telemetry.sink(tele.showoff.Conf(notebook), [
+        showoff_views = [
             views.LineGraph(['train_loss', 'val_loss'], 'Loss'),
             views.LineGraph(['train_pckh_all', 'val_pckh_all'], 'PCKh all'),
             views.LineGraph(['train_pckh_total', 'val_pckh_total'], 'PCKh total'),
@@ -170,14 +249,19 @@ class Reporting:
             views.Inspect(['args'], 'Command-line arguments', flatten=True),
             views.Images(['train_sample'], 'Training samples', images_per_row=2),
             views.Images(['val_sample'], 'Validation samples', images_per_row=2),
-            views.Graphviz(['model_graph'], 'Model graph'),
-            views.LineGraph(['train_data_load_time', 'train_data_transfer_time',
+        ]
+        if model_graph:
+            showoff_views.append(views.Graphviz(['model_graph'], 'Model graph'))
+        showoff_views += [
+            views.LineGraph(['train_data_load_time', 'train_input_prep_time',
                 'train_forward_time', 'train_criterion_time',
                 'train_backward_time', 'train_optim_time', 'train_eval_time'],
                 'Training time breakdown'),
             views.Images(['train_heatmaps'], 'Training wrist heatmaps', images_per_row=2),
             views.Images(['val_heatmaps'], 'Validation wrist heatmaps', images_per_row=2),
-        ])
+        ]
+
+        self.telemetry.sink(tele.showoff.Conf(notebook), showoff_views)
 
 
 def main():
@@ -186,6 +270,9 @@ def main():
     args = parse_args()
     seed_random_number_generators(args.seed)
 
+    # Input sizes are fixed, so let cuDNN choose the fastest convolution algorithms
+    torch.backends.cudnn.benchmark = True
+
     epochs = args.epochs
     batch_size = args.batch_size
     use_train_aug = not args.no_aug
@@ -219,6 +306,39 @@ def main():
     model = build_mpii_pose_model(**model_desc)
     model.cuda()
 
+    if args.channels_last:
+        if not hasattr(torch, 'channels_last'):
+            raise Exception('--channels-last requires PyTorch 1.5 or later')
+        model.to(memory_format=torch.channels_last)
+
+    def prepare_input(in_tensor):
+        """Convert a batch of input images to the memory format used by the model."""
+
+        if args.channels_last:
+            return in_tensor.contiguous(memory_format=torch.channels_last)
+        return in_tensor
+
+    # The compiled functions are only used for forward passes. The original module is kept
+    # around for everything else (eg. saving state, reading heatmaps).
+    forward = model
+    forward_loss = model.forward_loss
+    if args.compile:
+        if not hasattr(torch, 'compile'):
+            raise Exception('--compile requires PyTorch 2.0 or later')
+        forward = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+        forward_loss = torch.compile(model.forward_loss)
+
+    # Mixed precision training. Loss scaling is only required for fp16.
+    if args.amp != 'none':
+        if not hasattr(torch, 'autocast'):
+            raise Exception('--amp requires PyTorch 1.10 or later')
+        amp_dtype = torch.float16 if args.amp == 'fp16' else torch.bfloat16
+        autocast = lambda: torch.autocast('cuda', dtype=amp_dtype)
+        scaler = torch.cuda.amp.GradScaler(enabled=(args.amp == 'fp16'))
+    else:
+        autocast = contextlib.ExitStack
+        scaler = None
+
     input_size = model.image_specs.size
 
     ####
@@ -227,11 +347,20 @@ def main():
 
     train_data = MPIIDataset('/datasets/mpii', 'train',
         use_aug=use_train_aug, image_specs=model.image_specs, max_length=args.train_samples)
-    train_loader = DataLoader(train_data, batch_size, num_workers=4, pin_memory=True, shuffle=True)
+    # The last partial batch is dropped to keep the input size fixed, unless there aren't
+    # enough samples for a single full batch
+    drop_last = len(train_data) >= batch_size
+    train_loader = DataLoader(train_data, batch_size, num_workers=4, pin_memory=True, shuffle=True,
+                              drop_last=drop_last, **worker_loader_options())
+    if drop_last:
+        train_samples_per_epoch = len(train_loader) * batch_size
+    else:
+        train_samples_per_epoch = len(train_data)
 
     val_data = MPIIDataset('/datasets/mpii', 'val',
         use_aug=False, image_specs=model.image_specs)
-    val_loader = DataLoader(val_data, batch_size, num_workers=4, pin_memory=True)
+    val_loader = DataLoader(val_data, batch_size, num_workers=4, pin_memory=True,
+                            **worker_loader_options())
 
     ####
     # Metrics and visualisation
@@ -241,21 +370,25 @@ def main():
     val_eval = PCKhEvaluator()
 
     def eval_metrics_for_batch(evaluator, batch, norm_out):
-        """Evaluate and accumulate performance metrics for batch."""
+        """Evaluate and accumulate performance metrics for batch.
 
-        norm_out = norm_out.type(torch.DoubleTensor)
+        The calculations are performed on whichever device the tensors in `batch` reside.
 
-        # Coords in original MPII dataset space
-        orig_out = torch.bmm(norm_out, batch['transform_m']).add_(
-            batch['transform_b'].expand_as(norm_out))
+        Returns:
+            The predicted coordinates in original MPII dataset space.
+        """
 
-        norm_target = batch['part_coords'].double()
-        orig_target = torch.bmm(norm_target, batch['transform_m']).add_(
-            batch['transform_b'].expand_as(norm_target))
+        transform_m = batch['transform_m'].float()
+        transform_b = batch['transform_b'].float()
+        norm_out = norm_out.type_as(transform_m)
 
-        head_lengths = batch['normalize'].double()
+        # Coords in original MPII dataset space
+        orig_out = torch.baddbmm(transform_b, norm_out, transform_m)
+        orig_target = torch.baddbmm(transform_b, batch['part_coords'], transform_m)
+
+        evaluator.add(orig_out, orig_target, batch['part_mask'], batch['normalize'])
 
-        evaluator.add(orig_out, orig_target, batch['part_mask'], head_lengths)
+        return orig_out
 
     reporting = Reporting(train_eval, val_eval)
     tel = reporting.telemetry
@@ -284,7 +417,7 @@ def main():
         for tag_name in args.tags:
             notebook.add_tag(tag_name)
 
-        reporting.setup_showoff_output(notebook)
+        reporting.setup_showoff_output(notebook, model_graph=args.model_graph)
 
         progress_frame = notebook.add_frame('Progress',
             bounds={'x': 0, 'y': 924, 'width': 1920, 'height': 64}
@@ -296,13 +429,14 @@ def main():
     tel['experiment_id'].set_value(experiment_id)
     tel['args'].set_value(vars(args))
 
-    # Generate a Graphviz graph to visualise the model
-    dummy_data = torch.cuda.FloatTensor(1, 3, input_size, input_size).uniform_(0, 1)
-    out_var = model(Variable(dummy_data, requires_grad=False))
-    if isinstance(out_var, list):
-        out_var = out_var[-1]
-    tel['model_graph'].set_value(make_dot(out_var, dict(model.named_parameters())))
-    del dummy_data
+    if args.model_graph:
+        # Generate a Graphviz graph to visualise the model
+        dummy_data = torch.cuda.FloatTensor(1, 3, input_size, input_size).uniform_(0, 1)
+        out_var = model(dummy_data)
+        if isinstance(out_var, list):
+            out_var = out_var[-1]
+        tel['model_graph'].set_value(make_dot(out_var, dict(model.named_parameters())))
+        del dummy_data, out_var
 
     best_val_acc_meter = tele.meter.MaxValueMeter(skip_reset=True)
 
@@ -341,61 +475,85 @@ def main():
         model.train()
         samples_processed = 0
 
-        with progressbar.ProgressBar(max_value=len(train_data)) as bar:
-            for i, batch in generator_timer(enumerate(train_loader), tel['train_data_load_time']):
+        nan_check_interval = 50
+        nan_flag = torch.cuda.FloatTensor(1).zero_()
+
+        with progressbar.ProgressBar(max_value=train_samples_per_epoch) as bar:
+            batches = CUDAPrefetcher(train_loader)
+            for i, batch in generator_timer(enumerate(batches), tel['train_data_load_time'],
+                                              args.sync_timers):
                 if hasattr(scheduler, 'batch_step'):
                     scheduler.batch_step()
 
-                with timer(tel['train_data_transfer_time']):
-                    in_var = Variable(batch['input'].cuda(), requires_grad=False)
-                    target_var = Variable(batch['part_coords'].cuda(), requires_grad=False)
-                    mask_var = Variable(batch['part_mask'].type(torch.cuda.FloatTensor), requires_grad=False)
-
-                with timer(tel['train_forward_time']):
-                    out_var = model(in_var)
-
-                with timer(tel['train_criterion_time']):
-                    loss = model.forward_loss(out_var, target_var, mask_var)
-
-                    if np.isnan(loss.data[0]):
-                        state = {
-                            'state_dict': model.state_dict(),
-                            'model_desc': model_desc,
-                            'optimizer': optimizer.state_dict(),
-                            'epoch': epoch,
-                            'input': in_var.data,
-                            'target': target_var.data,
-                            'mask': mask_var.data,
-                        }
-                        torch.save(state, 'model_dump.pth')
-                        raise Exception('training loss should not be nan')
-
-                    tel['train_loss'].add(loss.data[0])
-
-                with timer(tel['train_eval_time']):
+                with timer(tel['train_input_prep_time'], args.sync_timers):
+                    in_var = prepare_input(batch['input'])
+                    target_var = batch['part_coords']
+                    mask_var = batch['part_mask']
+
+                with timer(tel['train_forward_time'], args.sync_timers):
+                    # Heatmaps are only needed for the batch which is visualised
+                    model.keep_heatmaps = (i == 0)
+                    with autocast():
+                        out_var = forward(in_var)
+
+                with timer(tel['train_criterion_time'], args.sync_timers):
+                    with autocast():
+                        loss = forward_loss(out_var, target_var, mask_var)
+
+                    # NaNs are flagged on the GPU and only checked periodically, since reading
+                    # the loss on the host would force a synchronisation every iteration
+                    nan_flag = torch.max(nan_flag, loss.data.ne(loss.data).float())
+                    if (i + 1) % nan_check_interval == 0 or i + 1 == len(batches):
+                        if nan_flag[0] > 0:
+                            # The NaN may have come from any of the iterations since the last
+                            # check, so the batch which caused it is not known. The saved
+                            # parameters may already have been updated with NaN gradients.
+                            state = {
+                                'state_dict': model.state_dict(),
+                                'model_desc': model_desc,
+                                'optimizer': optimizer.state_dict(),
+                                'epoch': epoch,
+                                'iteration': i,
+                                'nan_check_interval': nan_check_interval,
+                            }
+                            torch.save(state, 'model_dump.pth')
+                            raise Exception(
+                                'training loss became nan at or before iteration {} (checked '
+                                'every {} iterations)'.format(i, nan_check_interval))
+
+                    tel['train_loss'].add(loss.data)
+
+                with timer(tel['train_eval_time'], args.sync_timers):
                     coords = model.compute_coords(out_var)
                     eval_metrics_for_batch(train_eval, batch, coords)
 
-                with timer(tel['train_backward_time']):
+                with timer(tel['train_backward_time'], args.sync_timers):
                     optimizer.zero_grad()
-                    loss.backward()
-
-                with timer(tel['train_optim_time']):
-                    optimizer.step()
+                    if scaler is None:
+                        loss.backward()
+                    else:
+                        scaler.scale(loss).backward()
+
+                with timer(tel['train_optim_time'], args.sync_timers):
+                    if scaler is None:
+                        optimizer.step()
+                    else:
+                        scaler.step(optimizer)
+                        scaler.update()
 
                 samples_processed += batch['input'].size(0)
                 bar.update(samples_processed)
 
                 if i == 0:
-                    vis['train_images'] = batch['input']
-                    vis['train_preds'] = coords
-                    vis['train_masks'] = batch['part_mask']
-                    vis['train_coords'] = batch['part_coords']
-                    vis['train_heatmaps'] = model.heatmaps.data.cpu()
+                    vis['train_images'] = batch['input'].cpu()
+                    vis['train_preds'] = coords.cpu()
+                    vis['train_masks'] = batch['part_mask'].cpu()
+                    vis['train_coords'] = batch['part_coords'].cpu()
+                    vis['train_heatmaps'] = model.heatmaps.data.float().cpu()
 
                 if progress_frame is not None:
-                    so_far = epoch * len(train_data) + samples_processed
-                    total = epochs * len(train_data)
+                    so_far = epoch * train_samples_per_epoch + samples_processed
+                    total = epochs * train_samples_per_epoch
                     notebook.set_progress(so_far / total)
                     progress_frame.progress(so_far, total)
 
@@ -403,41 +561,65 @@ def main():
         '''Do a full pass over the validation set, evaluating model performance.'''
 
         model.eval()
-        val_preds = torch.DoubleTensor(len(val_data), 16, 2)
+        # Predictions are gathered on the GPU and copied to the host once at the end
+        val_preds = torch.cuda.FloatTensor(len(val_data), 16, 2)
         samples_processed = 0
 
-        with progressbar.ProgressBar(max_value=len(val_data)) as bar:
-            for i, batch in enumerate(val_loader):
-                in_var = Variable(batch['input'].cuda(), volatile=True)
-                target_var = Variable(batch['part_coords'].cuda(), volatile=True)
-                mask_var = Variable(batch['part_mask'].type(torch.cuda.FloatTensor), volatile=True)
-
-                out_var = model(in_var)
-                loss = model.forward_loss(out_var, target_var, mask_var)
-                tel['val_loss'].add(loss.data[0])
+        with torch.no_grad(), progressbar.ProgressBar(max_value=len(val_data)) as bar:
+            for i, batch in enumerate(CUDAPrefetcher(val_loader)):
+                in_var = prepare_input(batch['input'])
+                target_var = batch['part_coords']
+                mask_var = batch['part_mask']
+
+                model.keep_heatmaps = (i == 0)
+                with autocast():
+                    out_var = forward(in_var)
+                    loss = forward_loss(out_var, target_var, mask_var)
+                tel['val_loss'].add(loss.data)
                 coords = model.compute_coords(out_var)
-                eval_metrics_for_batch(val_eval, batch, coords)
+                orig_preds = eval_metrics_for_batch(val_eval, batch, coords)
 
-                preds = coords.double()
                 pos = i * batch_size
-                orig_preds = val_preds[pos:(pos + preds.size(0))]
-                torch.baddbmm(
-                    batch['transform_b'],
-                    preds,
-                    batch['transform_m'],
-                    out=orig_preds)
+                val_preds[pos:(pos + orig_preds.size(0))] = orig_preds
 
                 samples_processed += batch['input'].size(0)
                 bar.update(samples_processed)
 
                 if i == 0:
-                    vis['val_images'] = batch['input']
-                    vis['val_preds'] = coords
-                    vis['val_masks'] = batch['part_mask']
-                    vis['val_coords'] = batch['part_coords']
-                    vis['val_heatmaps'] = model.heatmaps.data.cpu()
-
-            tel['val_preds'].set_value(val_preds.numpy())
+                    vis['val_images'] = batch['input'].cpu()
+                    vis['val_preds'] = coords.cpu()
+                    vis['val_masks'] = batch['part_mask'].cpu()
+                    vis['val_coords'] = batch['part_coords'].cpu()
+                    vis['val_heatmaps'] = model.heatmaps.data.float().cpu()
+
+            tel['val_preds'].set_value(val_preds.cpu().double().numpy())
+
+    def visualise(subset, dataset, vis):
+        """Draw predicted skeletons and wrist heatmaps for the samples in `vis`."""
+
+        samples = []
+        for i in range(min(16, vis[subset + '_images'].size(0))):
+            img = model.image_specs.unconvert(vis[subset + '_images'][i], dataset)
+            coords = (vis[subset + '_preds'][i] + 1) * (input_size / 2)
+            draw_skeleton(img, coords, vis[subset + '_masks'][i])
+            samples.append(img)
+
+        heatmaps = vis[subset + '_heatmaps']
+        heatmap_images = []
+        lwrist_id = PCKhEvaluator.JOINT_NAMES.index('lwrist')
+        rwrist_id = PCKhEvaluator.JOINT_NAMES.index('rwrist')
+        for i in range(min(16, heatmaps.size(0))):
+            lwrist_hm = heatmaps[i, lwrist_id]
+            rwrist_hm = heatmaps[i, rwrist_id]
+            lwrist_hm = (lwrist_hm / lwrist_hm.max()).clamp_(0, 1)
+            rwrist_hm = (rwrist_hm / rwrist_hm.max()).clamp_(0, 1)
+            img = to_pil_image(torch.stack([rwrist_hm, lwrist_hm.clone().zero_(), lwrist_hm], 0))
+            heatmap_images.append(img)
+
+        return {subset + '_sample': samples, subset + '_heatmaps': heatmap_images}
+
+    # Visualisations are drawn on a separate thread so that they don't hold up training
+    vis_executor = ThreadPoolExecutor(max_workers=1)
 
     print('Entering the main training loop')
 
@@ -449,38 +631,11 @@ def main():
 
         print('Training pass...')
         train(epoch)
+        # Visualise training samples in the background while validating
+        train_vis = vis_executor.submit(visualise, 'train', train_data, dict(vis))
         print('Validation pass...')
         validate(epoch)
-
-        train_sample = []
-        for i in range(min(16, vis['train_images'].size(0))):
-            img = model.image_specs.unconvert(vis['train_images'][i], train_data)
-            coords = (vis['train_preds'][i] + 1) * (input_size / 2)
-            draw_skeleton(img, coords, vis['train_masks'][i])
-            train_sample.append(img)
-        tel['train_sample'].set_value(train_sample)
-
-        val_sample = []
-        for i in range(min(16, vis['val_images'].size(0))):
-            img = model.image_specs.unconvert(vis['val_images'][i], val_data)
-            coords = (vis['val_preds'][i] + 1) * (input_size / 2)
-            draw_skeleton(img, coords, vis['val_masks'][i])
-            val_sample.append(img)
-        tel['val_sample'].set_value(val_sample)
-
-        def visualise_heatmaps(key):
-            heatmap_images = []
-            for i in range(min(16, vis[key].size(0))):
-                lwrist_hm = vis[key][i, PCKhEvaluator.JOINT_NAMES.index('lwrist')]
-                rwrist_hm = vis[key][i, PCKhEvaluator.JOINT_NAMES.index('rwrist')]
-                lwrist_hm = (lwrist_hm / lwrist_hm.max()).clamp_(0, 1)
-                rwrist_hm = (rwrist_hm / rwrist_hm.max()).clamp_(0, 1)
-                img = ToPILImage()(torch.stack([rwrist_hm, lwrist_hm.clone().zero_(), lwrist_hm], 0))
-                heatmap_images.append(img)
-            tel[key].set_value(heatmap_images)
-
-        visualise_heatmaps('train_heatmaps')
-        visualise_heatmaps('val_heatmaps')
+        val_vis = vis_executor.submit(visualise, 'val', val_data, dict(vis))
 
         val_acc = val_eval.meters['total_mpii'].value()[0]
         is_best = best_val_acc_meter.add(val_acc)
@@ -499,6 +654,10 @@ def main():
                 torch.save(state, os.path.join(exp_out_dir, 'model-best.pth'))
                 tel['best_val_preds'].set_value(tel['val_preds'].value())
 
+        for future in [train_vis, val_vis]:
+            for meter_name, images in future.result().items():
+                tel[meter_name].set_value(images)
+
         tel.step()
         train_eval.reset()
         val_eval.reset()
@@ -2,6 +2,7 @@
 Dataset loaders.
 '''
 
+import inspect
 import random
 
 import math
@@ -11,11 +12,67 @@ import torch.nn.functional
 import torchvision.transforms as transforms
 from PIL import Image
 from torch import nn
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from torchdata.mpii import MpiiData, MPII_Joint_Horizontal_Flips, MPII_Image_Mean, \
     MPII_Image_Stddev, transform_keypoints
 
 
+def worker_loader_options(prefetch_factor=4):
+    """Get extra DataLoader options for keeping workers alive and busy.
+
+    Persistent workers are not respawned at the start of each epoch. The options are only
+    returned when the installed version of PyTorch supports them.
+    """
+
+    loader_params = inspect.signature(DataLoader.__init__).parameters
+    if 'persistent_workers' not in loader_params:
+        return {}
+    return {'persistent_workers': True, 'prefetch_factor': prefetch_factor}
+
+
+class CUDAPrefetcher:
+    """Wrap a data loader such that batches are copied to the GPU ahead of time.
+
+    Each batch is copied to the GPU on a side CUDA stream while the previous batch is being
+    processed. Tensors in the batches should be in pinned memory (ie. use `pin_memory=True`
+    for the data loader) for the copies to be asynchronous.
+
+    Args:
+        loader: The data loader to wrap. Batches are expected to be dicts.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        batches = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(stream):
+                return {k: v.cuda(non_blocking=True) if torch.is_tensor(v) else v
+                        for k, v in batch.items()}
+
+        next_batch = preload()
+        while next_batch is not None:
+            batch = next_batch
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(stream)
+            for value in batch.values():
+                if torch.is_tensor(value):
+                    # Prevent the memory from being reused before we are done with it
+                    value.record_stream(current_stream)
+            next_batch = preload()
+            yield batch
+
+
 class ImageSpecs():
     def __init__(self, size, subtract_mean, divide_stddev):
         self._size = size
@@ -78,7 +135,7 @@ class ImageSpecs():
         for t, m, s in zip(img_tensor, mean, stddev):
             t.mul_(s).add_(m)
 
-        img = transforms.ToPILImage()(img_tensor)
+        img = transforms.functional.to_pil_image(img_tensor)
         return img
 
 
@@ -218,7 +275,7 @@ class MPIIDataset(Dataset):
             'transform_b': trans_b,
             'transform_m': trans_m,
             'input': input_image,
-            'part_mask': part_mask,
+            'part_mask': part_mask.float(),
             'part_coords': part_coords.float(),
             'hflip': hflip,
         }
@@ -3,7 +3,8 @@ Human pose metric evaluation code.
 '''
 
 import torch
-from torchnet.meter import AverageValueMeter
+
+from dsnt.meter import FastAverageMeter
 
 
 class PCKhEvaluator:
@@ -49,18 +50,23 @@ class PCKhEvaluator:
         self.threshold = threshold
 
         meter_names = self.JOINT_NAMES + list(self.JOINT_GROUPS.keys())
-        meters = {name: AverageValueMeter() for name in meter_names}
+        meters = {name: FastAverageMeter() for name in meter_names}
 
-        meters_for_joints = {}
-        for j, meter_name in enumerate(self.JOINT_NAMES):
-            meters_for_joints[j] = {meters[meter_name]}
+        joints_for_meters = {}
+        for j, joint_name in enumerate(self.JOINT_NAMES):
+            joints_for_meters[joint_name] = [j]
         for meter_name, joint_names in self.JOINT_GROUPS.items():
-            for joint_name in joint_names:
-                j = self.JOINT_NAMES.index(joint_name)
-                meters_for_joints[j].add(meters[meter_name])
+            joints_for_meters[meter_name] = [self.JOINT_NAMES.index(n) for n in joint_names]
+
+        # Matrix for summing per-joint totals into per-meter totals
+        meter_joints = torch.zeros(len(self.JOINT_NAMES), len(meter_names)).double()
+        for m, meter_name in enumerate(meter_names):
+            for j in joints_for_meters[meter_name]:
+                meter_joints[j, m] = 1
 
         self.meters = meters
-        self._meters_for_joints = meters_for_joints
+        self._meter_names = meter_names
+        self._meter_joints = meter_joints
 
     @staticmethod
     def calculate_pckh_distance(pred, target, ref_dist):
@@ -69,16 +75,24 @@ class PCKhEvaluator:
     def add(self, pred, target, joint_mask, head_lengths):
         '''Calculate and accumulate PCKh values for batch.'''
 
-        batch_size = pred.size(0)
-        n_joints = pred.size(1)
+        # Distances for all joints in the batch, relative to head segment length
+        dists = (target - pred).pow(2).sum(-1).sqrt()
+        dists = dists / head_lengths.type_as(dists).view(-1, 1)
+
+        mask = joint_mask.type_as(dists)
+        hits = dists.le(self.threshold).type_as(dists) * mask
+
+        if self._meter_joints.type() != dists.type():
+            self._meter_joints = self._meter_joints.type_as(dists)
+
+        # Hit and joint counts for each meter. These stay on the same device as the inputs,
+        # so no synchronisation is required until the meter values are read. Batches with
+        # fewer joints only count towards the meters for the joints which they have.
+        meter_joints = self._meter_joints[:pred.size(1)]
+        totals = torch.stack([hits.sum(0), mask.sum(0)], 0).mm(meter_joints)
 
-        for b in range(batch_size):
-            for j in range(n_joints):
-                if joint_mask[b, j] == 1:
-                    dist = self.calculate_pckh_distance(target[b, j], pred[b, j], head_lengths[b])
-                    thresholded = 1 if dist <= self.threshold else 0
-                    for meter in self._meters_for_joints[j]:
-                        meter.add(thresholded)
+        for m, meter_name in enumerate(self._meter_names):
+            self.meters[meter_name].add_batch(totals[0, m], totals[1, m])
 
     def reset(self):
         '''Reset accumulated values to zero.'''
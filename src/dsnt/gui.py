@@ -1,50 +1,225 @@
 import tkinter as tk
 import tkinter.filedialog
 import tkinter.font
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 
+import numpy as np
 import torch
-import torchvision.transforms
+import torch.nn.functional
 from PIL import ImageTk, Image
-from torch.autograd import Variable
 from torchdata.mpii import MPII_Joint_Names, MpiiData
 
 from dsnt.data import MPIIDataset
 from dsnt.util import draw_skeleton
 
 
-@lru_cache(maxsize=32)
-def generate_heatmaps(model, mpii_data: MpiiData, index):
+# Maps joint names to their positions in the model output
+JOINT_ID = {name: i for i, name in enumerate(MPII_Joint_Names)}
+
+# Results of running the model on samples, keyed by (model, mpii_data, index). The cache is
+# filled both on demand and by prefetching neighbouring samples in the background.
+_HEATMAP_CACHE_SIZE = 32
+_heatmap_cache = OrderedDict()
+# Held while using the model or heatmap cache, since prefetching happens on another thread
+_model_lock = threading.Lock()
+# Number of on-demand model runs in progress. Background work waits for these to finish, so
+# that the heatmap being shown is not held up behind prefetching.
+_on_demand_runs = 0
+_on_demand_runs_changed = threading.Condition()
+# Page-locked staging buffer for copying input batches to the GPU, reused between batches
+_pinned_input = None
+_pinned_input_copied = None
+
+
+def _copy_input_to_gpu(batch):
+    """Copy a batch of images to the GPU via the pinned staging buffer.
+
+    Must be called while holding `_model_lock`.
+    """
+
+    global _pinned_input, _pinned_input_copied
+
+    if _pinned_input is None or _pinned_input.size(0) < batch.size(0) \
+            or _pinned_input.size()[1:] != batch.size()[1:]:
+        _pinned_input = torch.FloatTensor(batch.size()).pin_memory()
+    elif _pinned_input_copied is not None:
+        # Don't overwrite the buffer while the previous copy may still be in progress
+        _pinned_input_copied.synchronize()
+
+    staged = _pinned_input[:batch.size(0)]
+    staged.copy_(batch)
+    gpu_batch = staged.cuda(non_blocking=True)
+    _pinned_input_copied = torch.cuda.Event()
+    _pinned_input_copied.record()
+
+    return gpu_batch
+
+
+@lru_cache(maxsize=64)
+def _load_image(mpii_data: MpiiData, index):
+    """Load and decode an image, caching the result.
+
+    The returned image is shared, so it must not be modified.
+    """
+
     img = mpii_data.load_image(index)
-    orig_width, orig_height = img.size
+    img.load()
+    return img
+
+
+def _prepare_input(model, mpii_data: MpiiData, index, bb):
+    img = _load_image(mpii_data, index)
+    orig_size = img.size
 
-    bb = mpii_data.get_bounding_box(index)
-    bb = [int(round(x)) for x in bb]
     size = bb[2] - bb[0]
     img = img.crop(bb)
     img = img.resize((model.image_specs.size, model.image_specs.size), Image.BILINEAR)
 
-    print('Running model on: {}'.format(mpii_data.image_names[index]))
     img_tensor = model.image_specs.convert(img, MPIIDataset)
-    img_tensor = img_tensor.unsqueeze(0).type(torch.cuda.FloatTensor)
-    model(Variable(img_tensor, volatile=True))
-    hms_tensor = model.heatmaps.data.cpu()[0]
-
-    heatmaps = []
-
-    for hm_tensor in hms_tensor.split(1, 0):
-        # Scale and clamp pixel values
-        hm_tensor.div_(hm_tensor.max()).clamp_(0, 1)
-        # Convert tensor to PIL Image
-        hm_img = torchvision.transforms.ToPILImage()(hm_tensor)
-        hm_img = hm_img.resize((size, size), Image.NEAREST)
-        # "Uncrop" heatmap to match original image size
-        hm_padded = Image.new('RGB', (orig_width, orig_height), (0, 0, 0))
-        hm_padded.paste(hm_img, (bb[0], bb[1]))
-        # Add heatmap to list
-        heatmaps.append(hm_padded)
+    return img_tensor, (bb, size, orig_size)
+
 
-    return heatmaps
+def _wait_for_on_demand_runs():
+    with _on_demand_runs_changed:
+        while _on_demand_runs > 0:
+            _on_demand_runs_changed.wait()
+
+
+def _run_model_batch(model, mpii_data: MpiiData, indices, bbs, background=False):
+    """Run the model on a batch of samples at once, caching the results.
+
+    Duplicate samples and samples which already have cached results are skipped.
+
+    Args:
+        model: The pose estimation model
+        mpii_data: The MPII dataset
+        indices: Indices of the samples in the dataset
+        bbs: Integer bounding boxes of the samples, as (left, top, right, bottom)
+        background: If True, give way to any on-demand model runs before using the model
+    """
+
+    def uncached(indices):
+        return [index for index in indices if (model, mpii_data, index) not in _heatmap_cache]
+
+    bbs_by_index = OrderedDict(zip(indices, bbs))
+    with _model_lock:
+        indices = uncached(bbs_by_index.keys())
+    if len(indices) == 0:
+        return
+
+    # Preparing inputs only uses the CPU, so it is done without holding the lock
+    inputs = {index: _prepare_input(model, mpii_data, index, bbs_by_index[index])
+              for index in indices}
+
+    if background:
+        _wait_for_on_demand_runs()
+
+    with _model_lock:
+        # Another thread may have cached some of the samples in the meantime
+        indices = uncached(indices)
+        if len(indices) == 0:
+            return
+
+        img_tensors = [inputs[index][0] for index in indices]
+        placements = [inputs[index][1] for index in indices]
+
+        print('Running model on: {}'.format(
+            ', '.join(mpii_data.image_names[index] for index in indices)))
+        batch = _copy_input_to_gpu(torch.stack(img_tensors, 0))
+        with torch.no_grad():
+            model(batch)
+        # Heatmaps are kept on the GPU, only the joint being shown is copied to the host.
+        # Scale and clamp pixel values for all joints at once.
+        hms_batch = model.heatmaps.detach()
+        hm_maxs = hms_batch.contiguous().view(*hms_batch.size()[:-2], -1).max(-1)[0]
+        hms_batch = (hms_batch / hm_maxs.clamp(min=1e-8).unsqueeze(-1).unsqueeze(-1)).clamp_(0, 1)
+
+        for index, hms_tensor, placement in zip(indices, hms_batch, placements):
+            _heatmap_cache[(model, mpii_data, index)] = (hms_tensor, *placement)
+        while len(_heatmap_cache) > _HEATMAP_CACHE_SIZE:
+            _heatmap_cache.popitem(last=False)
+
+
+def _run_model(model, mpii_data: MpiiData, index, bb):
+    """Run the model on a sample, returning the raw heatmaps and where they belong in the image.
+
+    Only the raw heatmaps are cached (on the GPU), all image construction is left to
+    `_build_heatmap_image` so that it is only done for the joint which is actually shown.
+    """
+
+    global _on_demand_runs
+
+    key = (model, mpii_data, index)
+    with _on_demand_runs_changed:
+        _on_demand_runs += 1
+    try:
+        while True:
+            _run_model_batch(model, mpii_data, [index], [bb])
+            with _model_lock:
+                # The result could be evicted by another thread before it is read, in which
+                # case the model is simply run again
+                if key in _heatmap_cache:
+                    _heatmap_cache.move_to_end(key)
+                    return _heatmap_cache[key]
+    finally:
+        with _on_demand_runs_changed:
+            _on_demand_runs -= 1
+            _on_demand_runs_changed.notify_all()
+
+
+class _HeatmapPrefetcher:
+    """Runs the model on samples ahead of time, on a single long-lived background thread.
+
+    Only the latest request is kept. A request made while a batch is already running
+    replaces any request which is still waiting, so samples which the user has already
+    moved past are never processed. Batches give way to on-demand model runs.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._request = None
+        self._thread = None
+
+    def request(self, model, mpii_data: MpiiData, indices, bbs):
+        with self._cond:
+            self._request = (model, mpii_data, indices, bbs)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._request is None:
+                    self._cond.wait()
+                request = self._request
+                self._request = None
+            try:
+                _run_model_batch(*request, background=True)
+            except Exception:
+                # Prefetching is only an optimisation, so keep the worker alive
+                traceback.print_exc()
+
+
+def _build_heatmap_image(hms_tensor, joint_id, size):
+    """Build a greyscale image of a single joint's heatmap, matching the size of the crop.
+
+    The heatmap values are expected to already be scaled to the range [0, 1].
+    """
+
+    # Upscale the heatmap to the size of the crop on the GPU
+    hm_tensor = hms_tensor[joint_id].view(1, 1, hms_tensor.size(-2), hms_tensor.size(-1))
+    hm_tensor = torch.nn.functional.interpolate(hm_tensor, size=(size, size), mode='nearest')
+    # Convert tensor to a single channel PIL Image, copying only the final bytes to the host
+    hm_array = hm_tensor[0, 0].mul(255).byte().cpu().numpy()
+    hm_img = Image.frombuffer('L', hm_array.shape[::-1], hm_array.tobytes(), 'raw', 'L', 0, 1)
+
+    return hm_img
 
 
 class PoseResultsFrame(tk.Frame):
@@ -60,8 +235,27 @@ class PoseResultsFrame(tk.Frame):
         self.preds = preds
         self.model = model
 
+        # Read all of the annotations up front as arrays, rather than indexing into the
+        # dataset on every repaint
+        self._keypoints = np.asarray(mpii_data.keypoints)
+        self._keypoint_masks = np.asarray(mpii_data.keypoint_masks)
+        # Bounding boxes (rounded to whole pixels) for each sample in the subset
+        self._bbs = np.round([mpii_data.get_bounding_box(index) for index in subset_indices])
+        self._bbs = self._bbs.astype(np.int32)
+
         self.savable_image = None
 
+        # Rendered images are cached based on everything which affects how they look
+        self._render_bitmap = lru_cache(maxsize=16)(self._render_bitmap)
+        self._last_render_key = None
+        self._pending_update = None
+        self._last_hm_key = None
+        self._last_hm_img = None
+        # Heatmaps are generated on a worker thread, so that the GUI stays responsive
+        self._heatmap_executor = ThreadPoolExecutor(max_workers=1)
+        self._requested_hm_key = None
+        self._prefetcher = _HeatmapPrefetcher()
+
         self.init_gui()
 
     @property
@@ -88,29 +282,73 @@ class PoseResultsFrame(tk.Frame):
         index = self.subset_indices[self.cur_sample]
         self.var_index.set('Index: {:04d}'.format(index))
 
+        joint_id = None
         if self.show_heatmap:
-            img = self.get_joint_heatmap()
-        else:
-            img = self.mpii_data.load_image(index)
+            joint_id = JOINT_ID[self.var_joint.get()]
 
-        if self.var_skeleton.get() == self.SKELETON_TRUTH:
-            draw_skeleton(img, self.mpii_data.keypoints[index], self.mpii_data.keypoint_masks[index])
-        elif self.var_skeleton.get() == self.SKELETON_PREDICTION:
-            draw_skeleton(img, self.preds[self.cur_sample], self.mpii_data.keypoint_masks[index])
+        width = self.image_panel.winfo_width()
+        height = self.image_panel.winfo_height() - 2
 
-        if self.crop_as_input:
-            # Calculate crop used for input
-            bb = self.mpii_data.get_bounding_box(index)
-            img = img.crop(bb)
+        # Repaints (eg. from <Configure> events) often don't change anything
+        key = (self.cur_sample, self.var_skeleton.get(), self.crop_as_input, joint_id,
+               width, height)
+        if key == self._last_render_key:
+            return
 
-        self.savable_image = img.copy()
+        if joint_id is not None and (index, joint_id) != self._last_hm_key:
+            # The current image stays up until the heatmap is ready, then this is called again
+            self.request_heatmap(index, self.bounding_box(self.cur_sample), joint_id)
+            return
 
-        width = self.image_panel.winfo_width()
-        height = self.image_panel.winfo_height() - 2
-        img.thumbnail((width, height), Image.ANTIALIAS)
+        self.savable_image, img = self._render_bitmap(*key)
         tkimg = ImageTk.PhotoImage(img)
         self.image_panel.configure(image=tkimg)
         self.image_panel.image = tkimg
+        self._last_render_key = key
+
+    def schedule_update(self, delay=50):
+        """Update the image after a short delay, replacing any update which is already pending.
+
+        This collapses bursts of events (eg. while resizing the window) into a single update.
+        """
+
+        if self._pending_update is not None:
+            self.after_cancel(self._pending_update)
+        self._pending_update = self.after(delay, self._do_scheduled_update)
+
+    def _do_scheduled_update(self):
+        self._pending_update = None
+        self.update_image()
+
+    def _render_bitmap(self, sample, skeleton, crop_as_input, joint_id, width, height):
+        """Render the image for a sample.
+
+        Returns:
+            The full size image and its thumbnail for displaying in the image panel.
+        """
+
+        index = self.subset_indices[sample]
+
+        if joint_id is not None:
+            img = self.get_joint_heatmap(index, self.bounding_box(sample), joint_id)
+        else:
+            # Skeletons are drawn in place, so the cached image must be copied
+            img = _load_image(self.mpii_data, index).copy()
+
+        if skeleton == self.SKELETON_TRUTH:
+            draw_skeleton(img, self._keypoints[index], self._keypoint_masks[index])
+        elif skeleton == self.SKELETON_PREDICTION:
+            draw_skeleton(img, self.preds[sample], self._keypoint_masks[index])
+
+        if crop_as_input:
+            # Crop to the region used as model input
+            img = img.crop(self.bounding_box(sample))
+
+        full_img = img.copy()
+        # Bilinear filtering is good enough for an interactive preview, and much faster
+        img.thumbnail((width, height), Image.BILINEAR)
+
+        return full_img, img
 
     def on_key(self, event):
         """Handle keyboard event."""
@@ -133,6 +371,9 @@ class PoseResultsFrame(tk.Frame):
 
         self.update_image()
 
+        if event.keysym in {'Right', 'Left'}:
+            self.prefetch_heatmaps()
+
     def on_key_cur_sample(self, event):
         if event.keysym == 'Return':
             self.update_image()
@@ -153,13 +394,69 @@ class PoseResultsFrame(tk.Frame):
         if filename:
             self.savable_image.save(filename)
 
-    def get_joint_heatmap(self):
-        joint_id = MPII_Joint_Names.index(self.var_joint.get())
+    def prefetch_heatmaps(self, n_neighbours=4):
+        """Run the model on samples around the current one in the background."""
 
-        index = self.subset_indices[self.cur_sample]
-        heatmaps = generate_heatmaps(self.model, self.mpii_data, index)
+        if self.model is None or not self.show_heatmap:
+            return
+
+        n_samples = len(self.subset_indices)
+        offsets = [d * sign for d in range(1, n_neighbours + 1) for sign in [1, -1]]
+        samples = [(self.cur_sample + offset) % n_samples for offset in offsets]
+        indices = [self.subset_indices[sample] for sample in samples]
+        bbs = [self.bounding_box(sample) for sample in samples]
+
+        self._prefetcher.request(self.model, self.mpii_data, indices, bbs)
+
+    def bounding_box(self, sample):
+        """Get the bounding box used to crop the model input for a sample."""
+        return tuple(int(x) for x in self._bbs[sample])
+
+    def _generate_heatmap(self, index, bb, joint_id):
+        hms_tensor, bb, size, orig_size = _run_model(self.model, self.mpii_data, index, bb)
+        hm_img = _build_heatmap_image(hms_tensor, joint_id, size)
+        # "Uncrop" heatmap to match original image size. Skeletons are drawn in colour, so
+        # the canvas is RGB, but only the pasted crop needs converting from greyscale.
+        hm_padded = Image.new('RGB', orig_size, (0, 0, 0))
+        hm_padded.paste(hm_img, (bb[0], bb[1]))
+        return hm_padded
+
+    def request_heatmap(self, index, bb, joint_id):
+        """Generate a heatmap in the background, updating the image once it is ready."""
+
+        hm_key = (index, joint_id)
+        if hm_key == self._requested_hm_key:
+            return
+        self._requested_hm_key = hm_key
+
+        def on_done(future):
+            # Hand the result back to the Tk thread
+            try:
+                self.after(0, self._on_heatmap_ready, hm_key, future)
+            except (RuntimeError, tk.TclError):
+                # The window has been closed
+                pass
+
+        future = self._heatmap_executor.submit(self._generate_heatmap, index, bb, joint_id)
+        future.add_done_callback(on_done)
+
+    def _on_heatmap_ready(self, hm_key, future):
+        if hm_key != self._requested_hm_key:
+            # A different heatmap has been requested since
+            return
+        self._requested_hm_key = None
+        self._last_hm_img = future.result()
+        self._last_hm_key = hm_key
+        self.update_image()
+
+    def get_joint_heatmap(self, index, bb, joint_id):
+        # Changing other options (eg. the skeleton) redraws the same heatmap
+        if (index, joint_id) != self._last_hm_key:
+            self._last_hm_img = self._generate_heatmap(index, bb, joint_id)
+            self._last_hm_key = (index, joint_id)
 
-        return heatmaps[joint_id].copy()
+        # The caller is free to draw on the returned image
+        return self._last_hm_img.copy()
 
     def init_gui(self):
         self.master.title('Pose estimation results explorer')
@@ -189,13 +486,13 @@ class PoseResultsFrame(tk.Frame):
         self.var_skeleton.set(self.SKELETON_PREDICTION)
         opt_skeleton = tk.OptionMenu(
             toolbar, self.var_skeleton, self.SKELETON_NONE, self.SKELETON_TRUTH,
-            self.SKELETON_PREDICTION, command=lambda event: self.update_image())
+            self.SKELETON_PREDICTION, command=lambda event: self.schedule_update())
         opt_skeleton.pack(side=tk.LEFT, fill=tk.Y, padx=2, pady=2)
 
         self.var_crop_as_input = tk.IntVar()
         cb_crop = tk.Checkbutton(toolbar, text='Crop',
                                  variable=self.var_crop_as_input,
-                                 command=self.update_image)
+                                 command=self.schedule_update)
         cb_crop.pack(side=tk.LEFT, fill=tk.Y, padx=2, pady=2)
 
         btn_save = tk.Button(toolbar, text='Save image',
@@ -208,13 +505,13 @@ class PoseResultsFrame(tk.Frame):
         self.var_joint.set(MPII_Joint_Names[0])
         opt_joint = tk.OptionMenu(
             toolbar, self.var_joint, *MPII_Joint_Names,
-            command=lambda event: self.update_image())
+            command=lambda event: self.schedule_update())
         opt_joint.pack(side=tk.LEFT, fill=tk.Y, padx=2, pady=2)
 
         self.var_show_heatmap = tk.IntVar()
         cb_hm = tk.Checkbutton(toolbar, text='Show heatmap',
                                  variable=self.var_show_heatmap,
-                                 command=self.update_image)
+                                 command=self.schedule_update)
         cb_hm.pack(side=tk.LEFT, fill=tk.Y, padx=2, pady=2)
         if self.model is None:
             cb_hm['state'] = tk.DISABLED
@@ -227,7 +524,7 @@ class PoseResultsFrame(tk.Frame):
         image_panel.bind('<Key>', self.on_key)
         image_panel.focus_set()
         image_panel.bind('<Button-1>', lambda event: event.widget.focus_set())
-        image_panel.bind('<Configure>', lambda event: self.update_image())
+        image_panel.bind('<Configure>', lambda event: self.schedule_update())
         self.image_panel = image_panel
 
         self.pack()
@@ -1,7 +1,6 @@
 import progressbar
 import torch
 from tele.meter import SumMeter
-from torch.autograd import Variable
 from torch.utils.data import DataLoader
 from torchdata.mpii import MpiiData
 
@@ -24,7 +23,7 @@ def generate_predictions(model, dataset, use_flipped=True, batch_size=1, time_me
     preds = torch.DoubleTensor(len(dataset), 16, 2).zero_()
 
     completed = 0
-    with progressbar.ProgressBar(max_value=len(dataset)) as bar:
+    with torch.no_grad(), progressbar.ProgressBar(max_value=len(dataset)) as bar:
         for i, batch in enumerate(loader):
             batch_size = batch['input'].size(0)
             sum_meter.reset()
@@ -33,7 +32,7 @@ def generate_predictions(model, dataset, use_flipped=True, batch_size=1, time_me
                 if use_flipped:
                     sample = batch['input']
                     rev_sample = reverse_tensor(batch['input'], -1)
-                    in_var = Variable(torch.cat([sample, rev_sample], 0).cuda(), volatile=True)
+                    in_var = torch.cat([sample, rev_sample], 0).cuda()
 
                     hm_var = model.forward_part1(in_var)
                     if isinstance(hm_var, list):
@@ -47,13 +46,13 @@ def generate_predictions(model, dataset, use_flipped=True, batch_size=1, time_me
                     out_var = model.forward_part2(hm)
                     coords = model.compute_coords(out_var)
                 else:
-                    in_var = Variable(batch['input'].cuda(), volatile=True)
+                    in_var = batch['input'].cuda()
                     out_var = model(in_var)
                     coords = model.compute_coords(out_var)
 
                 orig_preds = torch.baddbmm(
                     batch['transform_b'],
-                    coords.double(),
+                    coords.cpu().double(),
                     batch['transform_m'])
 
             pos = i * batch_size
@@ -0,0 +1,58 @@
+'''
+Metric meters.
+'''
+
+import numpy as np
+from torchnet.meter import AverageValueMeter
+
+
+class FastAverageMeter(AverageValueMeter):
+    '''Average value meter which accepts pre-aggregated batch updates.
+
+    Calling `add_batch(total, n)` is equivalent to calling `add` for each of
+    the `n` values which sum to `total`, but avoids the Python overhead of
+    doing so.
+
+    Values may be given as tensors (including GPU tensors), in which case the
+    running totals are kept as tensors on the same device. They are only
+    converted to numbers when `value` is called, so updating the meter does
+    not force a synchronisation with the GPU.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.reset()
+
+    def add(self, value):
+        self.add_batch(value, 1, value * value)
+
+    def add_batch(self, total, n, total_sq=None):
+        '''Accumulate `n` values which sum to `total`.
+
+        Args:
+            total: The sum of the values.
+            n: The number of values.
+            total_sq: The sum of the squared values. May be omitted if all of the
+                values are either 0 or 1.
+        '''
+
+        if total_sq is None:
+            total_sq = total
+        self.sum = self.sum + total
+        self.sum_sq = self.sum_sq + total_sq
+        self.n = self.n + n
+
+    def value(self):
+        n = float(self.n)
+        if n == 0:
+            return np.nan, np.nan
+        mean = float(self.sum) / n
+        if n == 1:
+            return mean, np.inf
+        variance = max(float(self.sum_sq) - n * mean * mean, 0) / (n - 1)
+        return mean, np.sqrt(variance)
+
+    def reset(self):
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.n = 0
@@ -17,18 +17,35 @@ from dsnt.nn import euclidean_loss, thresholded_softmax
 from dsnt import util, hourglass
 from dsnt.data import ImageSpecs
 
+# Pretrained ResNet parameters which have already been loaded, keyed by base model type
+_PRETRAINED_CACHE = {}
+
 
 class HumanPoseModel(nn.Module):
     """Abstract base class for human pose estimation models."""
 
+    # When set to False, models are free to skip storing the `heatmaps` attribute during the
+    # forward pass if doing so allows for a faster implementation.
+    keep_heatmaps = True
+
+    @staticmethod
+    def _full_precision(x):
+        """Upcast reduced precision activations (eg. from mixed precision training) to float."""
+        if x.data.type().endswith(('HalfTensor', 'BFloat16Tensor')):
+            return x.float()
+        return x
+
     def _hm_preact(self, x, preact):
+        # Heatmaps are always normalised at full precision
+        x = self._full_precision(x)
+        if preact == 'softmax':
+            # Common case, which has a TorchScript implementation
+            return dsnt.nn.softmax_2d(x)
         n_chans = x.size(-3)
         height = x.size(-2)
         width = x.size(-1)
         x = x.view(-1, height * width)
-        if preact == 'softmax':
-            x = nn.functional.softmax(x, dim=-1)
-        elif preact == 'thresholded_softmax':
+        if preact == 'thresholded_softmax':
             x = thresholded_softmax(x, -0.5)
         elif preact == 'abs':
             x = x.abs()
@@ -45,6 +62,9 @@ class HumanPoseModel(nn.Module):
         return x
 
     def _calculate_reg_loss(self, target_var, mask_var, reg, hm_var, hm_sigma):
+        if reg == 'none':
+            return 0
+
         # Convert sigma (aka standard deviation) from pixels to normalized units
         sigma = (2.0 * hm_sigma / hm_var.size(-1))
 
@@ -146,12 +166,11 @@ class ResNetHumanPoseModel(HumanPoseModel):
         elif self.output_strat == 'fc':
             return euclidean_loss(out_var, target_var, mask_var)
         elif self.output_strat == 'gauss':
-            norm_coords = target_var.data.cpu()
             width = out_var.size(-1)
             height = out_var.size(-2)
 
-            target_hm = util.encode_heatmaps(norm_coords, width, height, self.hm_sigma)
-            target_hm_var = Variable(target_hm.cuda())
+            target_hm = util.encode_heatmaps(target_var.data, width, height, self.hm_sigma)
+            target_hm_var = Variable(target_hm)
 
             loss = nn.functional.mse_loss(out_var, target_hm_var)
             return loss
@@ -160,9 +179,9 @@ class ResNetHumanPoseModel(HumanPoseModel):
 
     def compute_coords(self, out_var):
         if self.output_strat == 'dsnt' or self.output_strat == 'fc':
-            return out_var.data.type(torch.FloatTensor)
+            return out_var.data.float()
         elif self.output_strat == 'gauss':
-            return util.decode_heatmaps(out_var.data.cpu())
+            return util.decode_heatmaps(self._full_precision(out_var).data)
 
         raise Exception('invalid configuration')
 
@@ -171,15 +190,22 @@ class ResNetHumanPoseModel(HumanPoseModel):
 
         x = self.fcn(x)
         x = self.hm_conv(x)
-        return x
+        # Heatmaps are always returned in the standard (NCHW) memory format, even when the
+        # convolutions use channels-last
+        return x.contiguous()
 
     def forward_part2(self, x):
         """Forward from unnormalized heatmaps to output"""
 
         if self.output_strat == 'dsnt':
-            x = self._hm_preact(x, self.preact)
-            self.heatmaps = x
-            x = dsnt.nn.dsnt(x)
+            if not self.keep_heatmaps and self.preact == 'softmax' and self.reg == 'none':
+                # Nothing needs the normalized heatmaps, so use a fused implementation
+                self.heatmaps = None
+                x = dsnt.nn.softmax_dsnt(self._full_precision(x))
+            else:
+                x = self._hm_preact(x, self.preact)
+                self.heatmaps = x
+                x = dsnt.nn.dsnt(x)
         elif self.output_strat == 'fc':
             x = self._hm_preact(x, self.preact)
             self.heatmaps = x
@@ -245,15 +271,17 @@ class HourglassHumanPoseModel(HumanPoseModel):
 
             return total_loss
         elif self.output_strat == 'gauss':
-            norm_coords = target_var.data.cpu()
             width = out_vars[0].size(-1)
             height = out_vars[0].size(-2)
 
-            target_hm = util.encode_heatmaps(norm_coords, width, height, self.hm_sigma)
-            target_hm_var = Variable(target_hm.cuda())
+            target_hm = util.encode_heatmaps(target_var.data, width, height, self.hm_sigma)
+            target_hm_var = Variable(target_hm)
 
-            # Calculate and sum up intermediate losses
-            loss = sum([nn.functional.mse_loss(hm, target_hm_var) for hm in out_vars])
+            # Calculate and sum up intermediate losses. Stacking the outputs allows for the
+            # losses to be calculated with a single reduction.
+            stacked = torch.stack(out_vars, 0)
+            loss = nn.functional.mse_loss(
+                stacked, target_hm_var.unsqueeze(0).expand_as(stacked)) * len(out_vars)
 
             return loss
 
@@ -264,16 +292,18 @@ class HourglassHumanPoseModel(HumanPoseModel):
             out_var = out_var[-1]
 
         if self.output_strat == 'dsnt' or self.output_strat == 'fc':
-            return out_var.data.type(torch.FloatTensor)
+            return out_var.data.float()
         elif self.output_strat == 'gauss':
-            return util.decode_heatmaps(out_var.data.cpu())
+            return util.decode_heatmaps(self._full_precision(out_var).data)
 
         raise Exception('invalid configuration')
 
     def forward_part1(self, x):
         """Forward from images to unnormalized heatmaps"""
 
-        return self.hg(x)
+        # Heatmaps are always returned in the standard (NCHW) memory format, even when the
+        # convolutions use channels-last
+        return [hm.contiguous() for hm in self.hg(x)]
 
     def forward_part2(self, hg_outs):
         """Forward from unnormalized heatmaps to output"""
@@ -325,18 +355,23 @@ def _build_resnet_pose_model(base, dilate=0, truncate=0, output_strat='dsnt', pr
     """
 
     if base == 'resnet18':
-        resnet = models.resnet18(pretrained=True)
+        resnet = models.resnet18()
     elif base == 'resnet34':
-        resnet = models.resnet34(pretrained=True)
+        resnet = models.resnet34()
     elif base == 'resnet50':
-        resnet = models.resnet50(pretrained=True)
+        resnet = models.resnet50()
     elif base == 'resnet101':
-        resnet = models.resnet101(pretrained=True)
+        resnet = models.resnet101()
     elif base == 'resnet152':
-        resnet = models.resnet152(pretrained=True)
+        resnet = models.resnet152()
     else:
         raise Exception('unsupported base model type: ' + base)
 
+    # Avoid reloading pretrained parameters when building the same model type repeatedly
+    if base not in _PRETRAINED_CACHE:
+        _PRETRAINED_CACHE[base] = model_zoo.load_url(models.resnet.model_urls[base])
+    resnet.load_state_dict(_PRETRAINED_CACHE[base])
+
     model = ResNetHumanPoseModel(
         resnet, n_chans=16, dilate=dilate, truncate=truncate, output_strat=output_strat,
         preact=preact, reg=reg, reg_coeff=reg_coeff, hm_sigma=hm_sigma)
@@ -16,25 +16,60 @@
 Differentiable DSNT operations for use in PyTorch computation graphs.
 """
 
+import contextlib
+
 import numpy as np
 import torch
 import torch.nn.functional
 from torch.autograd import Variable, Function
 
 
+def normalized_linspace(length):
+    """Generate a vector with values ranging from -1 to 1.
+
+    Note that the values correspond to the "centre" of each cell, so
+    -1 and 1 are always conceptually outside the bounds of the vector.
+    For example, if length = 4, the following vector is generated:
+
+    ```text
+     [ -0.75, -0.25,  0.25,  0.75 ]
+     ^              ^             ^
+    -1              0             1
+    ```
+    """
+
+    first = -(length - 1) / length
+    last = (length - 1) / length
+    return torch.linspace(first, last, length)
+
+
+def _script(fn):
+    """Compile `fn` with TorchScript where possible, falling back to the Python function."""
+
+    if not hasattr(torch.jit, 'script'):
+        return fn
+    try:
+        return torch.jit.script(fn)
+    except Exception:
+        return fn
+
+
+def _autocast_disabled(tensor):
+    """Context manager which disables autocasting (where supported) for ops on `tensor`."""
+
+    if not hasattr(torch, 'autocast'):
+        return contextlib.ExitStack()
+    return torch.autocast('cuda' if tensor.is_cuda else 'cpu', enabled=False)
+
+
 def generate_xy(inp):
     """Generate matrices X and Y."""
 
     *first_dims, height, width = inp.size()
 
-    first_x = -(width - 1) / width
-    first_y = -(height - 1) / height
-    last_x = (width - 1) / width
-    last_y = (height - 1) / height
-
     sing_dims = [1] * len(first_dims)
-    xs = torch.linspace(first_x, last_x, width).view(*sing_dims, 1, width).expand_as(inp)
-    ys = torch.linspace(first_y, last_y, height).view(*sing_dims, height, 1).expand_as(inp)
+    xs = normalized_linspace(width).view(*sing_dims, 1, width).expand_as(inp)
+    ys = normalized_linspace(height).view(*sing_dims, height, 1).expand_as(inp)
 
     if isinstance(inp, Variable):
         xs = Variable(xs, requires_grad=False)
@@ -73,9 +108,76 @@ def dsnt(heatmaps):
         Numerical coordinates corresponding to the locations in the heatmaps.
     """
 
-    xs, ys = generate_xy(heatmaps)
-    output = torch.stack([expectation_2d(xs, heatmaps), expectation_2d(ys, heatmaps)], -1)
-    return output
+    *first_dims, height, width = heatmaps.size()
+
+    # The x and y coordinates for each heatmap position, as a (height * width) x 2 matrix.
+    # This allows both expectations to be calculated with a single matrix multiplication.
+    xs = normalized_linspace(width).view(1, width).expand(height, width)
+    ys = normalized_linspace(height).view(height, 1).expand(height, width)
+    grid = torch.stack([xs.contiguous().view(-1), ys.contiguous().view(-1)], -1)
+
+    if isinstance(heatmaps, Variable):
+        grid = Variable(grid, requires_grad=False)
+
+    grid = grid.type_as(heatmaps)
+
+    flat = heatmaps.contiguous().view(-1, height * width)
+    # Mixed precision autocasting would otherwise run the matrix multiplication at reduced
+    # precision, but the expectations are always calculated at the precision of the heatmaps
+    with _autocast_disabled(heatmaps):
+        output = flat.mm(grid)
+    return output.view(*first_dims, 2)
+
+
+def softmax_dsnt(inp):
+    """Softmax followed by DSNT, without storing the normalized heatmaps.
+
+    This gives the same result as `dsnt(softmax_2d(inp))`, but the coordinate expectations
+    are calculated from the row and column marginals of the unnormalized exponentials.
+    As a result, neither the softmax output nor the full-size products of heatmap values and
+    coordinates are ever written out, and the entire operation is simple enough for a
+    compiler (eg. `torch.compile`) to fuse into a single pass over the input.
+
+    Args:
+        inp (torch.Tensor): Unnormalized heatmaps
+
+    Returns:
+        Numerical coordinates corresponding to the locations in the heatmaps.
+    """
+
+    *first_dims, height, width = inp.size()
+
+    xs = normalized_linspace(width)
+    ys = normalized_linspace(height)
+
+    if isinstance(inp, Variable):
+        xs = Variable(xs, requires_grad=False)
+        ys = Variable(ys, requires_grad=False)
+
+    xs = xs.type_as(inp)
+    ys = ys.type_as(inp)
+
+    output = _softmax_dsnt_kernel(inp.contiguous().view(-1, height, width), xs, ys)
+    return output.view(*first_dims, 2)
+
+
+def _softmax_dsnt_kernel(inp, xs, ys):
+    # Subtract the maximum value for numerical stability, as in a regular softmax
+    flat = inp.view(inp.size(0), -1)
+    flat = flat - flat.max(-1, keepdim=True)[0]
+    exps = flat.exp().view(inp.size())
+
+    col_sums = exps.sum(-2, keepdim=False)
+    row_sums = exps.sum(-1, keepdim=False)
+    total = row_sums.sum(-1, keepdim=False)
+
+    mean_x = (col_sums * xs).sum(-1, keepdim=False) / total
+    mean_y = (row_sums * ys).sum(-1, keepdim=False) / total
+
+    return torch.stack([mean_x, mean_y], -1)
+
+
+_softmax_dsnt_kernel = _script(_softmax_dsnt_kernel)
 
 
 def masked_average(losses, mask=None):
@@ -159,10 +261,17 @@ def thresholded_softmax(inp, threshold=-np.inf, eps=1e-12):
 
 def softmax_2d(inp):
     """Compute the softmax with the last two tensor dimensions combined."""
+    return _softmax_2d_kernel(inp)
+
+
+def _softmax_2d_kernel(inp):
     size = inp.size()
     flat = inp.view(-1, size[-1] * size[-2])
-    flat = torch.nn.functional.softmax(flat)
-    return flat.view(*size)
+    flat = torch.nn.functional.softmax(flat, dim=-1)
+    return flat.view(size)
+
+
+_softmax_2d_kernel = _script(_softmax_2d_kernel)
 
 
 def make_gauss(coords, width, height, sigma):
@@ -177,14 +286,9 @@ def make_gauss(coords, width, height, sigma):
         sigma: standard deviation of the Gaussian (units: normalized coordinates)
     """
 
-    first_x = -(width - 1) / width
-    first_y = -(height - 1) / height
-    last_x = (width - 1) / width
-    last_y = (height - 1) / height
-
     sing_dims = [1] * (coords.dim() - 1)
-    xs = torch.linspace(first_x, last_x, width).view(*sing_dims, 1, width).expand(*sing_dims, height, width)
-    ys = torch.linspace(first_y, last_y, height).view(*sing_dims, height, 1).expand(*sing_dims, height, width)
+    xs = normalized_linspace(width).view(*sing_dims, 1, width).expand(*sing_dims, height, width)
+    ys = normalized_linspace(height).view(*sing_dims, height, 1).expand(*sing_dims, height, width)
 
     if isinstance(coords, Variable):
         xs = Variable(xs, requires_grad=False)
@@ -2,6 +2,7 @@
 Miscellaneous utility functions.
 """
 
+import json
 import random
 import time
 from contextlib import contextmanager
@@ -126,24 +127,28 @@ def draw_gaussian(img_tensor, x, y, sigma, normalize=False, clip_size=None):
 
 
 def encode_heatmaps(coords, width, height, sigma=1):
-    '''Convert normalised coordinates into heatmaps.'''
+    '''Convert normalised coordinates into heatmaps.
 
-    # Normalised coordinates to pixel coordinates
-    coords.add_(1)
-    coords[:, :, 0].mul_(width / 2)
-    coords[:, :, 1].mul_(height / 2)
-    coords.add_(-0.5)
+    Each heatmap contains an unnormalised Gaussian centred on the pixel nearest to the
+    coordinates, clipped to a 7x7 window. The heatmaps are created on the same device as
+    `coords`.
+    '''
+
+    # Normalised coordinates to (rounded) pixel coordinates
+    x = (coords[:, :, 0] + 1).mul(width / 2).add(-0.5).round()
+    y = (coords[:, :, 1] + 1).mul(height / 2).add(-0.5).round()
 
-    batch_size = coords.size(0)
-    n_chans = coords.size(1)
-    target = torch.FloatTensor(batch_size, n_chans, height, width).zero_()
-    for i in range(batch_size):
-        for j in range(n_chans):
-            x = round(coords[i, j, 0])
-            y = round(coords[i, j, 1])
-            draw_gaussian(target[i, j], x, y, sigma, normalize=False, clip_size=7)
+    xs = torch.arange(0, width).type_as(coords).view(1, 1, 1, width)
+    ys = torch.arange(0, height).type_as(coords).view(1, 1, height, 1)
+    dx = xs - x.unsqueeze(-1).unsqueeze(-1)
+    dy = ys - y.unsqueeze(-1).unsqueeze(-1)
+
+    # The 2D Gaussian is separable, so calculate it as the product of two 1D Gaussians
+    k = -0.5 * (1 / sigma)**2
+    gauss_x = (dx.pow(2) * k).exp_() * dx.abs().le(3).type_as(dx)
+    gauss_y = (dy.pow(2) * k).exp_() * dy.abs().le(3).type_as(dy)
 
-    return target
+    return gauss_x * gauss_y
 
 
 def get_preds(heatmaps):
@@ -168,11 +173,14 @@ def get_preds(heatmaps):
 
 
 def decode_heatmaps(heatmaps, use_neighbours=True):
-    '''Convert heatmaps into normalised coordinates.'''
+    '''Convert heatmaps into normalised coordinates.
+
+    The calculations are performed on the same device as `heatmaps`.
+    '''
 
     coords = get_preds(heatmaps)
 
-    _, _, height, width = list(heatmaps.size())
+    batch_size, n_chans, height, width = list(heatmaps.size())
 
     if use_neighbours:
         # "To improve performance at high precision thresholds the prediction
@@ -180,14 +188,20 @@ def decode_heatmaps(heatmaps, use_neighbours=True):
         # neighbor before transforming back to the original coordinate space
         # of the image"
         #   - Stacked Hourglass Networks for Human Pose Estimation
-        for i, joint_coords in enumerate(coords):
-            for j, (x, y) in enumerate(joint_coords):
-                x = int(x)
-                y = int(y)
-                if x > 0 and x < width - 1 and y > 0 and y < height - 1:
-                    hm = heatmaps[i, j]
-                    joint_coords[j, 0] += (0.25 * np.sign(hm[y, x + 1] - hm[y, x - 1]))
-                    joint_coords[j, 1] += (0.25 * np.sign(hm[y + 1, x] - hm[y - 1, x]))
+        flat = heatmaps.contiguous().view(batch_size, n_chans, height * width)
+        xs = coords[:, :, 0].long()
+        ys = coords[:, :, 1].long()
+
+        def hm_at(x, y):
+            index = y.clamp(0, height - 1) * width + x.clamp(0, width - 1)
+            return flat.gather(2, index.unsqueeze(-1)).squeeze(-1)
+
+        # Only offset predictions which have neighbours on all sides
+        interior = (xs.gt(0) * xs.lt(width - 1) * ys.gt(0) * ys.lt(height - 1)).type_as(coords)
+        dx = (hm_at(xs + 1, ys) - hm_at(xs - 1, ys)).sign().type_as(coords)
+        dy = (hm_at(xs, ys + 1) - hm_at(xs, ys - 1)).sign().type_as(coords)
+        coords[:, :, 0].add_(0.25 * dx * interior)
+        coords[:, :, 1].add_(0.25 * dy * interior)
 
     # Pixel coordinates to normalised coordinates
     coords.add_(0.5)
@@ -211,16 +225,27 @@ def reverse_tensor(tensor, dim):
 
 
 @contextmanager
-def timer(meter):
+def timer(meter, cuda_sync=False):
+    """Time a block of code, adding the elapsed time to `meter`.
+
+    CUDA operations run asynchronously, so by default their time is only counted in whichever
+    block happens to wait for them. Setting `cuda_sync` synchronises the GPU at the start and
+    end of the block so that the GPU work queued inside it is included (at the cost of speed).
+    """
+
+    if cuda_sync:
+        torch.cuda.synchronize()
     start_time = time.perf_counter()
     yield
+    if cuda_sync:
+        torch.cuda.synchronize()
     time_elapsed = time.perf_counter() - start_time
     meter.add(time_elapsed)
 
 
-def generator_timer(generator, meter):
+def generator_timer(generator, meter, cuda_sync=False):
     while True:
-        with timer(meter):
+        with timer(meter, cuda_sync):
             vals = next(generator)
         yield vals
 
@@ -232,3 +257,10 @@ def seed_random_number_generators(seed):
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+
+
+def read_json_lines(file_path):
+    """Read a list of values from a newline-delimited JSON file."""
+
+    with open(file_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
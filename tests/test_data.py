@@ -28,3 +28,8 @@ class TestMPIIDataset(TestCase):
         self.assertEqual((3, 128, 128), sample['input'].size())
         self.assertEqual(-0.444027, sample['input'].min())
         self.assertEqual(0.567317, sample['input'].max())
+
+    def test_part_mask_is_float(self):
+        dataset = MPIIDataset('/datasets/mpii', 'train', use_aug=False)
+        sample = dataset[543]
+        self.assertEqual('torch.FloatTensor', sample['part_mask'].type())
@@ -37,3 +37,21 @@ class TestPCKhEvaluator(TestCase):
         actual, _ = evaluator.meters['all'].value()
 
         self.assertEqual(actual, expected)
+
+    def test_add_joint_groups(self):
+        evaluator = PCKhEvaluator(threshold=0.5)
+
+        n_joints = len(PCKhEvaluator.JOINT_NAMES)
+        pred = torch.zeros(2, n_joints, 2)
+        target = torch.zeros(2, n_joints, 2)
+        # Move the left wrist of the first example out of range
+        lwrist = PCKhEvaluator.JOINT_NAMES.index('lwrist')
+        target[0, lwrist, 0] = 10
+        head_length = torch.Tensor([1.0, 1.0])
+        joint_mask = torch.ones(2, n_joints)
+
+        evaluator.add(pred, target, joint_mask, head_length)
+
+        self.assertEqual(evaluator.meters['lwrist'].value()[0], 0.5)
+        self.assertEqual(evaluator.meters['rwrist'].value()[0], 1.0)
+        self.assertEqual(evaluator.meters['ubody'].value()[0], 11 / 12)
@@ -0,0 +1,48 @@
+import numpy as np
+import torch
+from tests.common import TestCase
+
+from dsnt.meter import FastAverageMeter
+
+
+class TestFastAverageMeter(TestCase):
+    def test_add_batch(self):
+        values = [1, 0, 1, 1, 0]
+
+        meter = FastAverageMeter()
+        meter.add_batch(sum(values), len(values))
+
+        expected_mean = np.mean(values)
+        expected_std = np.std(values, ddof=1)
+        actual_mean, actual_std = meter.value()
+
+        self.assertEqual(actual_mean, expected_mean)
+        self.assertEqual(actual_std, expected_std)
+
+    def test_add(self):
+        values = [0.5, 1.5, 4.0]
+
+        meter = FastAverageMeter()
+        for value in values:
+            meter.add(value)
+
+        expected_mean = np.mean(values)
+        expected_std = np.std(values, ddof=1)
+        actual_mean, actual_std = meter.value()
+
+        self.assertEqual(actual_mean, expected_mean)
+        self.assertEqual(actual_std, expected_std)
+
+    def test_add_batch_tensors(self):
+        values = torch.Tensor([1, 0, 1, 1, 0])
+
+        meter = FastAverageMeter()
+        meter.add_batch(values[:2].sum(), 2)
+        meter.add_batch(values[2:].sum(), 3)
+
+        expected_mean = np.mean(values.tolist())
+        expected_std = np.std(values.tolist(), ddof=1)
+        actual_mean, actual_std = meter.value()
+
+        self.assertEqual(actual_mean, expected_mean)
+        self.assertEqual(actual_std, expected_std)
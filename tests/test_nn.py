@@ -3,7 +3,7 @@ from torch.autograd import Variable, gradcheck
 from tests.common import TestCase
 
 from dsnt.nn import dsnt, euclidean_loss, thresholded_softmax, make_gauss,\
-    kl_reg_loss, js_reg_loss, mse_reg_loss, variance_reg_loss
+    kl_reg_loss, js_reg_loss, mse_reg_loss, variance_reg_loss, softmax_2d, softmax_dsnt
 
 
 class TestFunctionalDSNT(TestCase):
@@ -82,6 +82,24 @@ class TestFunctionalDSNT(TestCase):
         self.assertEqual(in_var.grad.data, expected_grad)
 
 
+class TestSoftmaxDSNT(TestCase):
+    def test_matches_unfused(self):
+        inp = torch.randn(2, 3, 5, 7)
+
+        in_var = Variable(inp, requires_grad=True)
+        expected = dsnt(softmax_2d(in_var))
+        expected.sum().backward()
+        expected_grad = in_var.grad.data.clone()
+
+        in_var = Variable(inp, requires_grad=True)
+        actual = softmax_dsnt(in_var)
+        actual.sum().backward()
+        actual_grad = in_var.grad.data
+
+        self.assertEqual(actual.data, expected.data)
+        self.assertEqual(actual_grad, expected_grad)
+
+
 class TestEuclideanLoss(TestCase):
     def test_forward_and_backward(self):
         input_tensor = torch.Tensor([
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 import torch
 from tests.common import TestCase
 
@@ -52,6 +55,21 @@ class TestUtil(TestCase):
 
         self.assertEqual(expected, actual, 1e-5)
 
+    def test_encode_heatmaps_batch(self):
+        coords = torch.Tensor([
+            [[-0.8, 0.8], [0.0, 0.0]],
+            [[3.0, 0.0], [-0.8, 0.8]],
+        ])
+
+        expected = torch.zeros(2, 2, 5, 5)
+        dsnt.util.draw_gaussian(expected[0, 0], 0, 4, 1, clip_size=7)
+        dsnt.util.draw_gaussian(expected[0, 1], 2, 2, 1, clip_size=7)
+        dsnt.util.draw_gaussian(expected[1, 1], 0, 4, 1, clip_size=7)
+
+        actual = dsnt.util.encode_heatmaps(coords, 5, 5)
+
+        self.assertEqual(expected, actual, 1e-5)
+
     def test_decode_heatmaps(self):
         heatmaps = torch.Tensor([[[
             [0.0, 0.9],
@@ -75,3 +93,14 @@ class TestUtil(TestCase):
         actual = dsnt.util.decode_heatmaps(heatmaps, use_neighbours=True)
 
         self.assertEqual(expected, actual, 1e-7)
+
+    def test_read_json_lines(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'values.jsonl')
+            with open(file_path, 'w') as f:
+                f.write('{"epoch": 0, "loss": [1.5, 0.5]}\n{"epoch": 1, "loss": [0.5, 0.25]}\n')
+
+            actual = dsnt.util.read_json_lines(file_path)
+
+        expected = [{'epoch': 0, 'loss': [1.5, 0.5]}, {'epoch': 1, 'loss': [0.5, 0.25]}]
+        self.assertListEqual(expected, actual)